@@ -1,32 +1,77 @@
 from mrjob.job import MRJob
 from mrjob.step import MRStep
 import json
-from datetime import datetime
+from json.encoder import encode_basestring_ascii as _json_str
+from array import array
+from math import isfinite
+
+# Colonnes de la sortie CLEAN de nettoyer_valider.py ("CLEAN\t<TSV>", ordre
+# du schéma v1; les colonnes ajoutées en v2 sont à la fin):
+_COL_TS = 1
+_COL_COUNTRY = 3
+_COL_UNIT_PRICE = 8
+_COL_QTY = 9
+_COL_IS_RETURN = 15
+
+# Schéma fixe des lignes SALES: même texte que json.dumps, sans son parcours générique
+_SALES_TEMPLATE = ('{"metric_type": "sales_by_country_month", "country": %s, '
+                   '"month": %s, "net_sales": %s, "transactions": %r, "quantity_sold": %r}')
+
+def _json_float(x):
+    # comme json.dumps: repr() si la valeur est finie, sinon NaN / Infinity
+    # (repr donnerait nan / inf, que json.loads refuse)
+    return repr(x) if isfinite(x) else json.dumps(x)
+
+# --- helpers (petits, locaux, sans effet de bord) ---
+def _to_float(x):
+    try:
+        return float(str(x).replace(',', '').strip())
+    except Exception:
+        return 0.0
+
+def _to_int(x):
+    try:
+        return int(str(x).strip())
+    except Exception:
+        return 0
+
+def _to_bool_int(x):
+    s = str(x).strip().lower()
+    return 1 if s in ('1', 'true', 't', 'yes', 'y') else 0
 
 class SalesAnalysisJob(MRJob):
-    # --- helpers (petits, locaux, sans effet de bord) ---
-    @staticmethod
-    def _to_float(x):
-        try:
-            return float(str(x).replace(',', '').strip())
-        except Exception:
-            return 0.0
-
-    @staticmethod
-    def _to_int(x):
-        try:
-            return int(str(x).strip())
-        except Exception:
-            return 0
-
-    @staticmethod
-    def _to_bool_int(x):
-        s = str(x).strip().lower()
-        return 1 if s in ('1', 'true', 't', 'yes', 'y') else 0
+    # nombre max de clés (country, year_month) gardées en mémoire par le mapper
+    IMC_MAX_KEYS = 50000
+
+    def mapper_init_sales(self):
+        # in-mapper combiner en colonnes (SoA): clé (country, year_month) -> index
+        # dans des tableaux typés, au lieu d'une liste Python par clé
+        self._agg_idx = {}
+        self._agg_amount = array('d')
+        self._agg_tx = array('q')
+        self._agg_qty = array('q')
+        # stats de retour: sommes signées par case (is_return << 1 | qty < 0);
+        # la valeur absolue est prise une seule fois dans mapper_final_sales
+        self._rs_qty = [0, 0, 0, 0]
+        self._rs_amount = [0.0, 0.0, 0.0, 0.0]
+        self._rs_rows = 0  # ventes traitées par ce mapper
+
+    def _flush_sales(self):
+        amounts, txs, qtys = self._agg_amount, self._agg_tx, self._agg_qty
+        for (country, year_month), i in self._agg_idx.items():
+            yield ((country, year_month), {
+                'amount': amounts[i],
+                'transactions': txs[i],
+                'qty': qtys[i]
+            })
+        self._agg_idx.clear()
+        self._agg_amount = array('d')
+        self._agg_tx = array('q')
+        self._agg_qty = array('q')
 
     def mapper_parse_sales(self, _, line):
         try:
-            # ligne MRJob: paire "<KEY>\t<JSON>" :
+            # ligne MRJob: "CLEAN\t<TSV>" (sortie de nettoyer_valider.py):
             parts = line.split('\t', 1)
             if len(parts) < 2:
                 return
@@ -37,39 +82,69 @@ class SalesAnalysisJob(MRJob):
             if key_type != 'CLEAN':
                 return
 
-            record = json.loads(parts[1])
+            # champs déjà strip() par nettoyer_valider:
+            cols = parts[1].split('\t')
+            country = cols[_COL_COUNTRY].upper() or 'UNKNOWN'
+            ts = cols[_COL_TS]
 
-            country = (record.get('country') or '').upper().strip() or 'UNKNOWN'
-            ts = record.get('ts', '')
-
-            # date: on accepte juste le YYYY-MM-DD du début:
-            try:
-                year_month = datetime.strptime(ts[:10], '%Y-%m-%d').strftime('%Y-%m')
-            except Exception:
+            # date: déjà validée par nettoyer_valider, on vérifie juste la forme
+            # YYYY-MM-DD du début et on garde YYYY-MM:
+            if len(ts) < 10 or ts[4] != '-' or ts[7] != '-':
                 return  # ignorer les lignes sans date exploitable
+            year_month = ts[:7]
 
-            unit_price = self._to_float(record.get('unit_price', 0))
-            qty = self._to_int(record.get('qty', 0))
-            is_return = self._to_bool_int(record.get('is_return', 0))
+            unit_price = _to_float(cols[_COL_UNIT_PRICE])
+            qty = _to_int(cols[_COL_QTY])
+            is_return = _to_bool_int(cols[_COL_IS_RETURN])
 
             amount = unit_price * qty
 
             self.increment_counter('processing', 'sales_processed', 1)
-            yield ((country, year_month), {
-                'amount': amount,
-                'transactions': 1,
-                'qty': qty
-            })
-
-            yield ('RETURN_STATS', {
-                'is_return': is_return,
-                'qty': abs(qty),
-                'amount': abs(amount)
-            })
+            self._rs_rows += 1
+
+            # in-mapper combiner: on cumule localement au lieu d'émettre par ligne:
+            k = (country, year_month)
+            i = self._agg_idx.get(k)
+            if i is None:
+                i = len(self._agg_idx)
+                self._agg_idx[k] = i
+                self._agg_amount.append(0.0)
+                self._agg_tx.append(0)
+                self._agg_qty.append(0)
+            self._agg_amount[i] += amount
+            self._agg_tx[i] += 1
+            self._agg_qty[i] += qty
+
+            b = (is_return << 1) | (qty < 0)
+            self._rs_qty[b] += qty
+            self._rs_amount[b] += amount
+
+            # borne mémoire: vider les cumuls s'il y a trop de clés:
+            if len(self._agg_idx) > self.IMC_MAX_KEYS:
+                yield from self._flush_sales()
 
         except Exception:
             self.increment_counter('errors', 'parse_errors', 1)
 
+    def mapper_final_sales(self):
+        yield from self._flush_sales()
+
+        # unit_price >= 0 (garanti par nettoyer_valider): amount a le signe de qty,
+        # donc |somme des négatifs| + somme des positifs = somme des abs()
+        q, a = self._rs_qty, self._rs_amount
+        return_qty = q[2] - q[3]
+        total_qty = q[0] - q[1] + return_qty
+        return_amount = a[2] - a[3]
+        total_amount = a[0] - a[1] + return_amount
+        # émis dès qu'une vente a été vue, même si toutes les quantités sont nulles
+        if self._rs_rows:
+            yield ('RETURN_STATS', {
+                'qty': total_qty,
+                'return_qty': return_qty,
+                'amount': total_amount,
+                'return_amount': return_amount
+            })
+
     def reducer_aggregate_sales(self, key, values):
         if key == 'RETURN_STATS':
             total_qty = 0
@@ -78,21 +153,22 @@ class SalesAnalysisJob(MRJob):
             return_amount = 0.0
 
             for v in values:
-                qty = v.get('qty', 0)
-                amt = v.get('amount', 0.0)
-                total_qty += qty
-                total_amount += amt
-                if v.get('is_return', 0) == 1:
-                    return_qty += qty
-                    return_amount += amt
+                total_qty += v['qty']
+                return_qty += v['return_qty']
+                total_amount += v['amount']
+                return_amount += v['return_amount']
 
             return_rate_qty = (return_qty / total_qty * 100) if total_qty > 0 else 0.0
             return_rate_amount = (return_amount / total_amount * 100) if total_amount > 0 else 0.0
 
-            yield ('RETURN_RATE', {
-                'total_quantity': total_qty, 'returned_quantity': return_qty, 'return_rate_by_qty': round(return_rate_qty, 2), 'total_amount': round(total_amount, 2),
-                'returned_amount': round(return_amount, 2), 'return_rate_by_amount': round(return_rate_amount, 2)
-            })
+            # sortie finale directement formatée (pas de seconde étape)
+            yield ('METRICS', json.dumps({
+                'metric_type': 'return_rate',
+                'data': {
+                    'total_quantity': total_qty, 'returned_quantity': return_qty, 'return_rate_by_qty': round(return_rate_qty, 2), 'total_amount': round(total_amount, 2),
+                    'returned_amount': round(return_amount, 2), 'return_rate_by_amount': round(return_rate_amount, 2)
+                }
+            }))
 
         else:
             country, year_month = key
@@ -101,39 +177,22 @@ class SalesAnalysisJob(MRJob):
             total_qty = 0
 
             for v in values:
-                total_amount += v.get('amount', 0.0)
-                total_transactions += v.get('transactions', 0)
-                total_qty += v.get('qty', 0)
-
-            yield ((country, year_month), {
-                'country': country, 'month': year_month, 'net_sales': round(total_amount, 2), 'transactions': total_transactions, 'quantity_sold': total_qty
-            })
-
-    def mapper_format_output(self, key, value):
-        if key == 'RETURN_RATE':
-            yield ('METRICS', json.dumps({
-                'metric_type': 'return_rate',
-                'data': value
-            }))
-        else:
-            country, year_month = key
-            yield ('SALES', json.dumps({
-                'metric_type': 'sales_by_country_month',
-                'country': country,
-                'month': year_month,
-                'net_sales': value['net_sales'],
-                'transactions': value['transactions'],
-                'quantity_sold': value['quantity_sold']
-            }))
-
-    def reducer_separate_outputs(self, key, values):
-        for value in values:
-            yield (key, value)
+                total_amount += v['amount']
+                total_transactions += v['transactions']
+                total_qty += v['qty']
+
+            yield ('SALES', _SALES_TEMPLATE % (
+                _json_str(country),
+                _json_str(year_month),
+                _json_float(round(total_amount, 2)),
+                total_transactions,
+                total_qty
+            ))
 
     def steps(self):
         return [
-            MRStep(mapper=self.mapper_parse_sales,
-                   reducer=self.reducer_aggregate_sales),
-            MRStep(mapper=self.mapper_format_output,
-                   reducer=self.reducer_separate_outputs)
+            MRStep(mapper_init=self.mapper_init_sales,
+                   mapper=self.mapper_parse_sales,
+                   mapper_final=self.mapper_final_sales,
+                   reducer=self.reducer_aggregate_sales)
         ]
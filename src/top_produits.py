@@ -4,8 +4,59 @@
 
 from mrjob.job import MRJob
 from mrjob.step import MRStep
-import json
 import csv
+import heapq
+import os
+
+CATALOG_FILE = 'catalogue_produits.csv'
+
+# Colonnes de la sortie CLEAN de nettoyer_valider.py ("CLEAN\t<TSV>", ordre
+# du schéma v1; les colonnes ajoutées en v2 sont à la fin):
+_COL_PRODUCT_ID = 5
+_COL_UNIT_PRICE = 8
+_COL_QTY = 9
+
+
+# -- helpers simples et robustes --
+def _to_float(x):
+    try:
+        return float(str(x).replace(',', '').strip())
+    except Exception:
+        return 0.0
+
+
+def _to_int(x):
+    try:
+        return int(str(x).strip())
+    except Exception:
+        return 0
+
+
+def _load_catalog(path):
+    """
+    Lit le catalogue avec csv pour gérer les virgules/quotes
+    Retourne {product_id: (name, category, subcategory)}
+    """
+    catalog = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter=',', quotechar='"', escapechar='\\')
+        header = next(reader, None)  # ignore l'en-tête
+        for row in reader:
+            if not row or row[0].startswith('#'):
+                continue
+            # on tolère les lignes courtes
+            product_id = (row[0] or '').strip() if len(row) > 0 else ''
+            product_name = (row[1] or '').strip() if len(row) > 1 else ''
+            category = (row[2] or '').strip() if len(row) > 2 else ''
+            subcategory = (row[3] or '').strip() if len(row) > 3 else ''
+            if product_id:
+                catalog[product_id] = (
+                    product_name or f'Unknown Product {product_id}',
+                    category or 'Unknown',
+                    subcategory or 'Unknown'
+                )
+    return catalog
+
 
 class TopProductsJob(MRJob):
     """
@@ -13,56 +64,37 @@ class TopProductsJob(MRJob):
     Effectue une jointure avec le catalogue produits
     """
 
-    FILES = ['catalogue_produits.csv']
+    FILES = [CATALOG_FILE]
 
-    # -- helpers simples et robustes --
-    @staticmethod
-    def _to_float(x):
-        try:
-            return float(str(x).replace(',', '').strip())
-        except Exception:
-            return 0.0
-
-    @staticmethod
-    def _to_int(x):
-        try:
-            return int(str(x).strip())
-        except Exception:
-            return 0
+    # catalogue partagé par les tâches d'un même processus: ((path, mtime, size), catalog)
+    _catalog_cache = None
 
     def mapper_init(self):
-        """Charge le catalogue produits (side-join) avec csv pour gérer les virgules/quotes"""
+        """Charge le catalogue produits (side-join), mis en cache sur la classe"""
         self.product_catalog = {}
+        # in-mapper combiner: product_id -> [amount, qty, transactions]
+        self._p = {}
         try:
-            with open('catalogue_produits.csv', 'r', encoding='utf-8') as f:
-                reader = csv.reader(f, delimiter=',', quotechar='"', escapechar='\\')
-                header = next(reader, None)  # ignore l'en-tête
-                for row in reader:
-                    if not row or row[0].startswith('#'):
-                        continue
-                    # on tolère les lignes courtes
-                    product_id = (row[0] or '').strip() if len(row) > 0 else ''
-                    product_name = (row[1] or '').strip() if len(row) > 1 else ''
-                    category = (row[2] or '').strip() if len(row) > 2 else ''
-                    subcategory = (row[3] or '').strip() if len(row) > 3 else ''
-                    if product_id:
-                        self.product_catalog[product_id] = {
-                            'name': product_name or f'Unknown Product {product_id}',
-                            'category': category or 'Unknown',
-                            'subcategory': subcategory or 'Unknown'
-                        }
+            # réutilise le catalogue déjà parsé tant que le fichier n'a pas changé
+            st = os.stat(CATALOG_FILE)
+            stamp = (os.path.abspath(CATALOG_FILE), st.st_mtime, st.st_size)
+            cache = TopProductsJob._catalog_cache
+            if cache is None or cache[0] != stamp:
+                cache = (stamp, _load_catalog(CATALOG_FILE))
+                TopProductsJob._catalog_cache = cache
+            self.product_catalog = cache[1]
             self.increment_counter('catalog', 'products_loaded', len(self.product_catalog))
         except Exception:
             self.increment_counter('errors', 'catalog_load_error', 1)
 
     def mapper_aggregate_by_product(self, _, line):
         """
-        Mapper 1: Agrège les ventes par produit
+        Mapper 1: Agrège les ventes par produit (in-mapper combiner)
         Clé: product_id
-        Valeur: montants/quantités/transactions + infos produit
+        Valeur: montants/quantités/transactions, émis dans mapper_final
         """
         try:
-            # lignes de type: "<KEY>\t<JSON>"
+            # lignes de type: "CLEAN\t<TSV>" (sortie de nettoyer_valider.py)
             parts = line.split('\t', 1)
             if len(parts) < 2:
                 return
@@ -72,38 +104,44 @@ class TopProductsJob(MRJob):
             if key_type != 'CLEAN':
                 return
 
-            record = json.loads(parts[1])
-
-            product_id = (record.get('product_id') or '').strip()
+            # champs déjà strip() par nettoyer_valider:
+            cols = parts[1].split('\t')
+            product_id = cols[_COL_PRODUCT_ID]
             if not product_id:
                 return
 
-            unit_price = self._to_float(record.get('unit_price', 0))
-            qty = self._to_int(record.get('qty', 0))
+            unit_price = _to_float(cols[_COL_UNIT_PRICE])
+            qty = _to_int(cols[_COL_QTY])
 
             amount = unit_price * qty  # net: retours négatifs déduisent le CA
 
-            # enrichissement depuis le catalogue (fallback Unknown)
-            info = self.product_catalog.get(product_id, {
-                'name': f'Unknown Product {product_id}',
-                'category': 'Unknown',
-                'subcategory': 'Unknown'
-            })
-
             self.increment_counter('processing', 'products_processed', 1)
 
-            yield (product_id, {
-                'amount': amount,
-                'qty': qty,
-                'transactions': 1,
-                'product_name': info['name'],
-                'category': info['category'],
-                'subcategory': info['subcategory']
-            })
+            # cumul local (in-mapper combiner), l'enrichissement est fait dans mapper_final
+            s = self._p.get(product_id)
+            if s is None:
+                s = [0.0, 0, 0]
+                self._p[product_id] = s
+            s[0] += amount
+            s[1] += qty
+            s[2] += 1
 
         except Exception:
             self.increment_counter('errors', 'parse_errors', 1)
 
+    def mapper_final(self):
+        """
+        Émet un seul enregistrement par product_id pour ce mapper,
+        enrichi une seule fois depuis le catalogue (fallback Unknown)
+        Valeur: tuple fixe (amount, qty, transactions, name, category, subcategory)
+        """
+        for product_id, (amount, qty, transactions) in self._p.items():
+            info = self.product_catalog.get(product_id)
+            if info is None:
+                info = (f'Unknown Product {product_id}', 'Unknown', 'Unknown')
+            yield (product_id, (amount, qty, transactions) + info)
+        self._p.clear()
+
     def reducer_sum_by_product(self, product_id, values):
         """
         Reducer 1: Somme les ventes par produit
@@ -116,14 +154,12 @@ class TopProductsJob(MRJob):
         category = ''
         subcategory = ''
 
-        for v in values:
-            total_amount += v.get('amount', 0.0)
-            total_qty += v.get('qty', 0)
-            total_transactions += v.get('transactions', 0)
+        for amount, qty, transactions, name, cat, subcat in values:
+            total_amount += amount
+            total_qty += qty
+            total_transactions += transactions
             if not product_name:
-                product_name = v.get('product_name', '')
-                category = v.get('category', '')
-                subcategory = v.get('subcategory', '')
+                product_name, category, subcategory = name, cat, subcat
 
         yield ('TOP', {
             'product_id': product_id,
@@ -139,10 +175,9 @@ class TopProductsJob(MRJob):
         """
         Reducer 2: Calcule le top 10 global par CA net (une seule réduction)
         """
-        # On collecte tout puis on trie (dataset compact après agrégation)
-        products = list(values)
-        products.sort(key=lambda x: x.get('net_revenue', 0.0), reverse=True)
-        for i, p in enumerate(products[:10], 1):
+        # Tas borné à 10 éléments: pas de liste complète ni de tri global
+        top = heapq.nlargest(10, values, key=lambda x: x['net_revenue'])
+        for i, p in enumerate(top, 1):
             yield (f'RANK_{i:02d}', {
                 'rank': i,
                 'product_id': p['product_id'],
@@ -159,6 +194,7 @@ class TopProductsJob(MRJob):
         return [
             MRStep(mapper_init=self.mapper_init,
                    mapper=self.mapper_aggregate_by_product,
+                   mapper_final=self.mapper_final,
                    reducer=self.reducer_sum_by_product),
             # Une seule réduction pour garantir un top 10 global
             MRStep(reducer=self.reducer_top_10,